@@ -1,9 +1,15 @@
 md5_path = "./md5.text"
+source_registry_path = "./source_registry.json"
+operator = "RM"
 
 # Chroma
 collection_name = "rag"
 persist_directory = "./chroma_db"
 
+# snapshot
+snapshot_path = "./kb_snapshot.npz"
+snapshot_batch_size = 5000
+
 # spliter
 chunk_size = 1000
 chunk_overlap = 100
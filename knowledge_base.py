@@ -1,12 +1,22 @@
 import hashlib
+import json
 import os
+import uuid
 from datetime import datetime
+from typing import List, Optional
 
+import numpy as np
 from langchain_community.embeddings import DashScopeEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 import config_data as config
+from vector_stores import TAG_PREFIX, TIME_FORMAT, to_timestamp
+
+# 快照文件格式版本,格式变化时递增
+SNAPSHOT_VERSION = 1
+# 删除缺少md5元数据的旧文本段时,附加在结果后的提示
+MISSING_MD5_WARNING = ";部分旧文本段没有md5元数据,其去重记录未能清除,重新载入相同内容前需手动从md5记录文件中删除"
 
 
 def check_md5(md5_str: str):
@@ -34,6 +44,86 @@ def save_md5(md5_str: str):
         f.write(md5_str + '\n')
 
 
+def remove_md5(md5_list):
+    """
+    :param md5_list: 从md5记录文件中删除这些md5字符串,删除后相同内容可以重新载入
+    """
+    md5_set = set(md5_list)
+    remaining = [md5_hex for md5_hex in load_md5_list() if md5_hex not in md5_set]
+    with open(config.md5_path, 'w', encoding='utf-8') as f:
+        f.writelines(md5_hex + '\n' for md5_hex in remaining)
+
+
+def load_source_registry():
+    """
+    :return: 来源登记表 {来源文件名: {"ids": [...], "md5": [...], "create_time": ..., "tags": [...]}}
+    """
+    if not os.path.exists(config.source_registry_path):
+        return {}
+    with open(config.source_registry_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_source_registry(registry: dict):
+    """
+    :param registry: 将来源登记表整体写入文件保存
+    """
+    with open(config.source_registry_path, 'w', encoding='utf-8') as f:
+        json.dump(registry, f, ensure_ascii=False, indent=2)
+
+
+def register_chunks(registry: dict, source: str, ids: list, md5_list: list, create_time: str, tags: list):
+    """将一批文本段id登记到来源登记表中对应来源下(不写文件)"""
+    entry = registry.setdefault(source, {"ids": [], "md5": [], "create_time": create_time, "tags": []})
+    for key, values in (("ids", ids), ("md5", md5_list), ("tags", tags)):
+        known = set(entry[key])
+        for value in values:
+            if value not in known:
+                entry[key].append(value)
+                known.add(value)
+    entry["create_time"] = max(entry["create_time"], create_time)
+
+
+def register_metadatas(registry: dict, ids: list, metadatas: list):
+    """按元数据中的来源汇总文本段,一次性登记到来源登记表(不写文件)"""
+    grouped = {}
+    for chunk_id, metadata in zip(ids, metadatas):
+        if not metadata or "source" not in metadata:
+            continue
+        group = grouped.setdefault(metadata["source"], {"ids": [], "md5": [], "create_time": "", "tags": []})
+        group["ids"].append(chunk_id)
+        if metadata.get("md5"):
+            group["md5"].append(metadata["md5"])
+        group["create_time"] = max(group["create_time"], metadata.get("create_time", ""))
+        group["tags"].extend(key[len(TAG_PREFIX):] for key in metadata if key.startswith(TAG_PREFIX))
+    for source, group in grouped.items():
+        register_chunks(registry, source, group["ids"], group["md5"], group["create_time"], group["tags"])
+
+
+def fill_create_timestamp(metadata) -> bool:
+    """
+    :param metadata: 文本段元数据,缺少 create_timestamp 时按 create_time 原地补齐
+    :return: True(补齐了时间戳)     False(无需或无法补齐)
+    """
+    if not metadata or "create_timestamp" in metadata or "create_time" not in metadata:
+        return False
+    try:
+        metadata["create_timestamp"] = to_timestamp(metadata["create_time"])
+    except ValueError:
+        return False
+    return True
+
+
+def load_md5_list():
+    """
+    :return: md5记录文件内所有已处理过的md5字符串(保持写入顺序)
+    """
+    if not os.path.exists(config.md5_path):
+        return []
+    with open(config.md5_path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
 def get_string_md5(input_str: str, encoding='utf-8'):
     """
     :param input_str:将输入的字符串转换为md5字符串
@@ -54,7 +144,7 @@ class KnowledgeBaseService(object):
         # 如果文件夹不存在则创建，如果存在则跳过
         os.makedirs(config.persist_directory, exist_ok=True)
         # 创建嵌入模型（需要环境变量 DASHSCOPE_API_KEY）
-        self.embeddings = DashScopeEmbeddings(model="text-embedding-v4")
+        self.embeddings = DashScopeEmbeddings(model=config.embedding_model_name)
         # 使用 Chroma 向量库（与本地持久化目录兼容）
         self.vs = Chroma(
             collection_name=config.collection_name,
@@ -67,33 +157,271 @@ class KnowledgeBaseService(object):
             separators=config.separators,  # 自然段落划分的符号
             length_function=len,  # 使用python自带的len函数做长度统计的依据
         )  # 文本分割器的对象
+        if not os.path.exists(config.source_registry_path):
+            # 首次启用来源登记表: 从向量库已有文本段的元数据重建
+            self._rebuild_source_registry()
 
-    def upload_by_str(self, data: str, filename):
+    def _update_registry(self, update):
         """
-        将传入的字符串,进行向量化,存入向量数据库中
+        修改来源登记表:每次都从文件重新读取,应用修改后立即写回
+        避免多个服务实例(如多个页面会话)用各自的旧副本互相覆盖
+        :param update: 接收登记表字典并原地修改的函数
         """
-        # 先得到传入字符串的md5值
-        md5_hex = get_string_md5(data)
+        registry = load_source_registry()
+        update(registry)
+        save_source_registry(registry)
 
-        if check_md5(md5_hex):
-            return "[跳过]内容已经在知识库中"
+    def _rebuild_source_registry(self):
+        """
+        从向量库中已有文本段的元数据重建来源登记表,
+        同时为旧文本段补齐 create_timestamp,使其能参与时间范围过滤
+        """
+        data = self.vs.get(include=["metadatas"])
+        ids, metadatas = data["ids"], data["metadatas"]
+        updated = [(chunk_id, metadata) for chunk_id, metadata in zip(ids, metadatas)
+                   if fill_create_timestamp(metadata)]
+        batch_size = config.snapshot_batch_size
+        for start in range(0, len(updated), batch_size):
+            batch = updated[start:start + batch_size]
+            # 只更新元数据,不传入文本与向量,不会调用嵌入模型
+            self.vs._collection.update(
+                ids=[chunk_id for chunk_id, _ in batch],
+                metadatas=[metadata for _, metadata in batch],
+            )
+        self._update_registry(lambda registry: register_metadatas(registry, ids, metadatas))
+
+    def _source_chunks(self, filename):
+        """
+        :return: (该来源的全部文本段id, 对应的md5列表, 是否存在缺少md5元数据的旧文本段)
+        登记表中的id与按元数据查到的id合并,避免漏掉登记表之外的文本段
+        """
+        entry = load_source_registry().get(filename, {"ids": [], "md5": []})
+        data = self.vs.get(where={"source": filename}, include=["metadatas"])
+        ids = list(dict.fromkeys(entry["ids"] + data["ids"]))
+        metadata_md5 = [metadata["md5"] for metadata in data["metadatas"] if metadata and metadata.get("md5")]
+        md5_list = list(dict.fromkeys(entry["md5"] + metadata_md5))
+        missing_md5 = any(not metadata or not metadata.get("md5") for metadata in data["metadatas"])
+        return ids, md5_list, missing_md5
+
+    def _add_chunks(self, data: str, md5_hex: str, filename, tags: list):
+        """
+        切分文本并向量化写入向量库
+        :return: (新文本段的id列表, 入库时间字符串)
+        """
         if len(data) > config.max_split_char_number:
             knowledge_chunks: list[str] = self.spliter.split_text(data)
         else:
             knowledge_chunks = [data]
+        now = datetime.now()
         metadata = {
             "source": filename,
-            "create_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "operator": "RM"
+            "create_time": now.strftime(TIME_FORMAT),
+            "create_timestamp": int(now.timestamp()),
+            "md5": md5_hex,
+            "operator": config.operator,
         }
+        for tag in tags:
+            metadata[TAG_PREFIX + tag] = True
+        # 显式指定文本段id,登记到来源下,之后可按来源精确删除
+        ids = [uuid.uuid4().hex for _ in knowledge_chunks]
         self.vs.add_texts(
             knowledge_chunks,
             metadatas=[metadata for _ in knowledge_chunks],
+            ids=ids,
         )
+        return ids, metadata["create_time"]
+
+    def upload_by_str(self, data: str, filename, tags: Optional[List[str]] = None):
+        """
+        将传入的字符串,进行向量化,存入向量数据库中
+        :param tags: 文档标签,可在检索时作为过滤条件
+        """
+        # 先得到传入字符串的md5值
+        md5_hex = get_string_md5(data)
+
+        if check_md5(md5_hex):
+            return "[跳过]内容已经在知识库中"
+        tags = tags or []
+        ids, create_time = self._add_chunks(data, md5_hex, filename, tags)
 
         save_md5(md5_hex)
+        self._update_registry(
+            lambda registry: register_chunks(registry, filename, ids, [md5_hex], create_time, tags)
+        )
         return "[成功]内容已经成功载入向量库"
 
+    def list_sources(self):
+        """
+        :return: 知识库中所有来源及其文本段数量、入库时间、标签
+        """
+        return {
+            source: {
+                "chunk_count": len(entry["ids"]),
+                "create_time": entry["create_time"],
+                "tags": list(entry["tags"]),
+            }
+            for source, entry in load_source_registry().items()
+        }
+
+    def delete_source(self, filename):
+        """
+        按来源删除其全部文本段,并清除对应的md5记录
+        """
+        ids, md5_list, missing_md5 = self._source_chunks(filename)
+        self._update_registry(lambda registry: registry.pop(filename, None))
+        if not ids:
+            return "[跳过]知识库中没有该来源的内容"
+        self.vs.delete(ids=ids)
+        remove_md5(md5_list)
+        result = f"[成功]已删除来源{filename}的{len(ids)}个文本段"
+        if missing_md5:
+            result += MISSING_MD5_WARNING
+        return result
+
+    def replace_source(self, data: str, filename, tags: Optional[List[str]] = None):
+        """
+        用新内容替换某个来源:先载入新内容,成功后再删除该来源的旧文本段
+        新内容载入失败或被跳过时,旧文本段保持不变
+        """
+        md5_hex = get_string_md5(data)
+        old_ids, old_md5_list, missing_md5 = self._source_chunks(filename)
+        if md5_hex in old_md5_list:
+            return "[跳过]新内容与该来源现有内容相同"
+        if check_md5(md5_hex):
+            return "[失败]新内容已经在知识库中,原来源未改动"
+        tags = tags or []
+        try:
+            new_ids, create_time = self._add_chunks(data, md5_hex, filename, tags)
+        except Exception as e:
+            return f"[失败]新内容载入失败,原来源未改动:{e}"
+
+        if old_ids:
+            self.vs.delete(ids=old_ids)
+        remove_md5(old_md5_list)
+        save_md5(md5_hex)
+
+        def replace_entry(registry):
+            registry.pop(filename, None)
+            register_chunks(registry, filename, new_ids, [md5_hex], create_time, tags)
+
+        self._update_registry(replace_entry)
+        result = f"[成功]已用新内容替换来源{filename}"
+        if missing_md5:
+            result += MISSING_MD5_WARNING
+        return result
+
+    def export_snapshot(self, path: str = config.snapshot_path):
+        """
+        将向量库中的文本、元数据、向量以及md5去重记录导出到一个npz快照文件
+        向量以float32矩阵单独存放,其余内容序列化为json字节,无需pickle即可读取
+        按批分页读取向量库,向量直接填入预分配的float32矩阵;文本、元数据与id仍在内存中汇总后整体序列化
+        """
+        total = len(self.vs.get(include=[])["ids"])
+        batch_size = config.snapshot_batch_size
+        ids, documents, metadatas = [], [], []
+        vectors = None
+        for offset in range(0, total, batch_size):
+            page = self.vs.get(
+                limit=batch_size,
+                offset=offset,
+                include=["documents", "metadatas", "embeddings"],
+            )
+            if not page["ids"]:
+                break
+            page_vectors = np.asarray(page["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.empty((total, page_vectors.shape[1]), dtype=np.float32)
+            vectors[len(ids):len(ids) + len(page["ids"])] = page_vectors
+            ids.extend(page["ids"])
+            documents.extend(page["documents"])
+            metadatas.extend(page["metadatas"])
+        if vectors is None:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        else:
+            # 导出期间集合若有删除,截掉未填充的行
+            vectors = vectors[:len(ids)]
+
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "embedding_model_name": self.embeddings.model,
+            "ids": ids,
+            "documents": documents,
+            "metadatas": metadatas,
+            "md5": load_md5_list(),
+        }
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        # 传入文件对象而非路径,避免numpy自动追加.npz后缀导致导入时找不到文件
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                vectors=vectors,
+                header=np.frombuffer(header_bytes, dtype=np.uint8),
+            )
+        return f"[成功]已导出{len(ids)}个文本段到快照{path}"
+
+    def import_snapshot(self, path: str = config.snapshot_path, merge: bool = False):
+        """
+        从npz快照文件批量载入向量库,直接写入已有向量,不再调用嵌入模型
+        :param merge: 目标向量库非空时必须为True才会合并导入;合并时跳过md5已在本地记录中的文本段,
+            其余文本段按id覆盖,md5记录只追加本地缺失的部分
+        """
+        with np.load(path) as snapshot:
+            header = json.loads(snapshot["header"].tobytes().decode('utf-8'))
+            vectors = snapshot["vectors"]
+
+        if header["version"] != SNAPSHOT_VERSION:
+            return f"[失败]不支持的快照版本:{header['version']}"
+        if header["embedding_model_name"] != self.embeddings.model:
+            return f"[失败]快照使用的嵌入模型({header['embedding_model_name']})与当前嵌入模型不一致"
+
+        ids = header["ids"]
+        documents = header["documents"]
+        metadatas = header["metadatas"]
+        # 写入前先完成全部校验,避免损坏的快照只写入了一部分批次
+        if not (vectors.shape[0] == len(ids) == len(documents) == len(metadatas)):
+            return "[失败]快照内容不完整:向量、文本与元数据数量不一致"
+        existing = self.vs.get(limit=1, include=["embeddings"])
+        if existing["ids"] and not merge:
+            return "[失败]向量库非空,如需合并导入请指定merge"
+        if ids and existing["ids"] and len(existing["embeddings"][0]) != vectors.shape[1]:
+            return f"[失败]快照向量维度({vectors.shape[1]})与向量库维度({len(existing['embeddings'][0])})不一致"
+
+        # 合并到非空向量库时,本地已载入过的内容(md5相同)即使文本段id不同也不再重复写入
+        local_md5 = set(load_md5_list())
+        keep = [index for index, metadata in enumerate(metadatas)
+                if not (existing["ids"] and metadata and metadata.get("md5") in local_md5)]
+        skipped = len(ids) - len(keep)
+        if skipped:
+            ids = [ids[index] for index in keep]
+            documents = [documents[index] for index in keep]
+            metadatas = [metadatas[index] for index in keep]
+            vectors = vectors[keep]
+
+        for metadata in metadatas:
+            fill_create_timestamp(metadata)
+        batch_size = config.snapshot_batch_size
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            # langchain的Chroma没有写入预计算向量的公开方法,add_texts会重新调用嵌入模型,故直接操作底层集合
+            self.vs._collection.upsert(
+                ids=ids[start:end],
+                embeddings=vectors[start:end].tolist(),
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+            )
+
+        # 快照中的元数据足以重建来源登记表
+        self._update_registry(lambda registry: register_metadatas(registry, ids, metadatas))
+
+        for md5_hex in header["md5"]:
+            if md5_hex not in local_md5:
+                save_md5(md5_hex)
+                local_md5.add(md5_hex)
+        result = f"[成功]已从快照载入{len(ids)}个文本段"
+        if skipped:
+            result += f",跳过{skipped}个本地已有内容的文本段"
+        return result
+
 
 if __name__ == '__main__':
     service = KnowledgeBaseService()
@@ -156,12 +156,13 @@ def print_prompt(prompt):
 
 
 class RagService(object):
-    def __init__(self, session_id: str = "default_session"):
+    def __init__(self, session_id: str = "default_session", metadata_filter: Optional[Dict] = None):
         """
         初始化RAG服务
 
         Args:
             session_id: 会话ID，用于区分不同用户的对话历史
+            metadata_filter: 检索时的元数据过滤条件（由 build_metadata_filter 生成），为None时检索整个知识库
         """
         self.session_id = session_id
         self.vector_service = VectorStoreService(
@@ -185,7 +186,7 @@ class RagService(object):
         )
 
         # 获取检索器
-        self.retriever = self.vector_service.get_retriever()
+        self.retriever = self.vector_service.get_retriever(metadata_filter)
         self.chat_model = ChatTongyi(model=config.chat_model_name)
         self.chain = self.__get_chain()
 
@@ -0,0 +1,17 @@
+import argparse
+
+import config_data as config
+from knowledge_base import KnowledgeBaseService
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="知识库快照导出/导入")
+    parser.add_argument("action", choices=["export", "import"], help="export:导出快照 import:载入快照")
+    parser.add_argument("path", nargs="?", default=config.snapshot_path, help="快照文件路径")
+    parser.add_argument("--merge", action="store_true", help="向量库非空时合并导入")
+    args = parser.parse_args()
+
+    service = KnowledgeBaseService()
+    if args.action == "export":
+        print(service.export_snapshot(args.path))
+    else:
+        print(service.import_snapshot(args.path, merge=args.merge))
@@ -1,6 +1,56 @@
+from datetime import datetime
+
 from langchain_community.vectorstores import Chroma
 import config_data as config
 
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# 标签以 "tag:<标签名>": True 的形式写入元数据,便于在向量检索时直接过滤
+TAG_PREFIX = "tag:"
+
+
+def to_timestamp(value):
+    """
+    :param value: datetime对象,或 "%Y-%m-%d %H:%M:%S" 格式的时间字符串
+    :return: 秒级时间戳(int),与元数据中的 create_timestamp 对应
+    """
+    if isinstance(value, str):
+        value = datetime.strptime(value, TIME_FORMAT)
+    return int(value.timestamp())
+
+
+def build_metadata_filter(source=None, start_time=None, end_time=None, tags=None):
+    """
+    将来源、时间范围、标签条件转换为Chroma的where过滤条件,过滤在向量检索内部完成
+    :param source: 单个来源文件名,或非空的来源文件名列表
+    :param start_time: 入库时间下限(包含)
+    :param end_time: 入库时间上限(包含)
+        时间范围按元数据 create_timestamp 过滤,没有该字段的文本段不会被匹配;
+        旧文本段会在首次建立来源登记表或导入快照时按 create_time 补齐该字段
+    :param tags: 标签列表,需同时具备全部标签
+    :return: where字典,没有任何条件时返回None
+    """
+    conditions = []
+    if source is not None:
+        if isinstance(source, str):
+            conditions.append({"source": source})
+        else:
+            source = list(source)
+            if not source:
+                raise ValueError("source列表不能为空")
+            conditions.append({"source": {"$in": source}})
+    if start_time is not None:
+        conditions.append({"create_timestamp": {"$gte": to_timestamp(start_time)}})
+    if end_time is not None:
+        conditions.append({"create_timestamp": {"$lte": to_timestamp(end_time)}})
+    for tag in tags or []:
+        conditions.append({TAG_PREFIX + tag: True})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
 
 class VectorStoreService(object):
     def __init__(self, embedding):
@@ -14,9 +64,21 @@ class VectorStoreService(object):
             persist_directory=config.persist_directory,
         )
 
-    def get_retriever(self):
-        """返回向量检索器,方便加入chain """
-        return self.vector_store.as_retriever(search_kwargs={"k": config.similarity_threshold})
+    def get_retriever(self, metadata_filter=None):
+        """
+        返回向量检索器,方便加入chain
+        :param metadata_filter: build_metadata_filter 生成的过滤条件,为None时检索整个集合
+        """
+        search_kwargs = {"k": config.similarity_threshold}
+        if metadata_filter:
+            search_kwargs["filter"] = metadata_filter
+        return self.vector_store.as_retriever(search_kwargs=search_kwargs)
+
+    def search(self, query: str, k: int = config.similarity_threshold,
+               source=None, start_time=None, end_time=None, tags=None):
+        """按元数据条件过滤后进行相似度检索"""
+        metadata_filter = build_metadata_filter(source, start_time, end_time, tags)
+        return self.vector_store.similarity_search(query, k=k, filter=metadata_filter)
 
 
 if __name__ == '__main__':